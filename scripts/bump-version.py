@@ -4,6 +4,7 @@ import argparse
 import re
 import subprocess
 import sys
+from functools import lru_cache
 from pathlib import Path
 from typing import List, Literal, Optional
 
@@ -26,6 +27,16 @@ LOCAL_CRATES = [
     "fresh-plugin-api-macros",
 ]
 
+# Top-level `version = "..."` line (the [workspace.package] version)
+_VERSION_RE = re.compile(r'^version = "(?P<v>[^"]*)"', re.MULTILINE)
+
+# The [workspace.package] version and the local crate versions in
+# [workspace.dependencies], e.g. `fresh-core = { version = "0.1.83", path = "..." }`
+_WORKSPACE_VERSIONS_RE = re.compile(
+    r'^(?P<prefix>(?:(?P<crate>' + "|".join(map(re.escape, LOCAL_CRATES)) + r') = \{ )?version = ")(?P<v>[^"]*)"',
+    re.MULTILINE,
+)
+
 def print_usage():
     """Prints the usage instructions."""
     print("Usage: ./scripts/bump-version.py [patch|minor|major]")
@@ -57,13 +68,32 @@ def run_command(command: List[str], capture_output: bool = False, check: bool =
     """Runs a shell command."""
     return subprocess.run(command, capture_output=capture_output, text=True, check=check)
 
-def get_current_version(cargo_toml_path: Path) -> str:
-    """Gets the current version from Cargo.toml."""
-    content = cargo_toml_path.read_text()
-    match = re.search(r'^version = "(.*)"', content, re.MULTILINE)
+def start_command(command: List[str]) -> subprocess.Popen:
+    """Starts a command in the background, capturing its output."""
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+def finish_command(process: subprocess.Popen) -> str:
+    """Waits for a command started with start_command and returns its stripped stdout."""
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args, stdout, stderr)
+    return stdout.strip()
+
+def get_current_version(content: str) -> str:
+    """Gets the current version from the contents of Cargo.toml."""
+    prefix = 'version = "'
+    for line in content.splitlines():
+        if line.startswith(prefix):
+            version = line[len(prefix):-1]
+            if line.endswith('"') and version.count(".") == 2:
+                return version
+            break
+
+    # Unusual layout (trailing comment, pre-release suffix, ...): use the regex
+    match = _VERSION_RE.search(content)
     if not match:
         raise ValueError("Could not find version in Cargo.toml")
-    return match.group(1)
+    return match.group("v")
 
 def calculate_new_version(current_version: str, bump_type: BumpType) -> str:
     """Calculates the new version."""
@@ -79,36 +109,104 @@ def calculate_new_version(current_version: str, bump_type: BumpType) -> str:
         patch = 0
     return f"{major}.{minor}.{patch}"
 
-def update_cargo_toml(cargo_toml_path: Path, current_version: str, new_version: str) -> None:
-    """Updates the version in Cargo.toml (both workspace.package and workspace.dependencies)."""
-    content = cargo_toml_path.read_text()
-
-    # Update [workspace.package] version
-    pattern = rf'^version = "{re.escape(current_version)}"'
-    new_content = re.sub(
-        pattern,
-        f'version = "{new_version}"',
-        content,
-        count=1,
-        flags=re.MULTILINE,
-    )
+def update_cargo_toml(cargo_toml_path: Path, content: str, current_version: str, new_version: str) -> None:
+    """Updates the version in Cargo.toml (both workspace.package and workspace.dependencies).
+
+    `content` is the text previously read from `cargo_toml_path`; all versions
+    are rewritten in a single pass over it.
+    """
+    package_updated = False
+
+    def replace(match: re.Match) -> str:
+        nonlocal package_updated
+        if match.group("crate") is None:
+            # Only the first top-level version belongs to [workspace.package]
+            if package_updated:
+                return match.group(0)
+            package_updated = True
+        elif match.group("v") != current_version:
+            return match.group(0)
+        return f'{match.group("prefix")}{new_version}"'
+
+    cargo_toml_path.write_text(_WORKSPACE_VERSIONS_RE.sub(replace, content))
+
+# The `members = [...]` list of the [workspace] table
+_MEMBERS_RE = re.compile(r'^members = \[(?P<paths>[^\]]*)\]', re.MULTILINE)
+
+# The first `name = "..."` line of a crate manifest (the [package] name)
+_PACKAGE_NAME_RE = re.compile(r'^name = "(?P<name>[^"]+)"', re.MULTILINE)
+
+# A Cargo.lock entry of a local (sourceless) package
+_LOCK_LOCAL_PACKAGE_RE = re.compile(
+    r'^(?P<prefix>\[\[package\]\]\nname = "(?P<name>[^"]+)"\nversion = ")(?P<v>[^"]+)"\n(?!source = )',
+    re.MULTILINE,
+)
+
+def get_workspace_members(cargo_toml_content: str) -> Optional[List[str]]:
+    """Gets the package names of the workspace members.
+
+    Returns None if a member manifest cannot be read or does not inherit the
+    workspace version (`version.workspace = true`).
+    """
+    match = _MEMBERS_RE.search(cargo_toml_content)
+    if not match:
+        return None
+    names = []
+    for member in re.findall(r'"([^"]+)"', match.group("paths")):
+        try:
+            manifest = (Path(member) / "Cargo.toml").read_text()
+        except OSError:
+            return None
+        name = _PACKAGE_NAME_RE.search(manifest)
+        if not name or "\nversion.workspace = true\n" not in manifest:
+            return None
+        names.append(name.group("name"))
+    return names
+
+def update_cargo_lock_inplace(cargo_lock_path: Path, members: List[str], current_version: str, new_version: str) -> bool:
+    """Rewrites the workspace crate versions in Cargo.lock directly.
+
+    A version-only bump of the workspace does not change dependency resolution,
+    so only the `version` lines of the workspace packages need to change.
+    Returns False without touching the file if the lock file does not have the
+    expected shape, in which case cargo should be used instead.
+    """
+    try:
+        content = cargo_lock_path.read_text()
+    except OSError:
+        return False
 
-    # Update local crate versions in [workspace.dependencies]
-    for crate in LOCAL_CRATES:
-        # Match pattern like: fresh-core = { version = "0.1.83", path = "..." }
-        pattern = rf'({re.escape(crate)} = \{{ version = "){re.escape(current_version)}(")'
-        new_content = re.sub(pattern, rf'\g<1>{new_version}\g<2>', new_content)
+    # Only patch when the local packages are exactly the workspace members and all
+    # carry the current version; anything else (a new member, a path dependency
+    # outside the workspace, a member with its own version) is left to cargo
+    local_packages = list(_LOCK_LOCAL_PACKAGE_RE.finditer(content))
+    if sorted(m.group("name") for m in local_packages) != sorted(members):
+        return False
+    if any(m.group("v") != current_version for m in local_packages):
+        return False
+    # Dependents only spell out "name version" when several versions are locked
+    if any(f'"{crate} {current_version}' in content for crate in members):
+        return False
 
-    cargo_toml_path.write_text(new_content)
+    new_content = _LOCK_LOCAL_PACKAGE_RE.sub(lambda m: f'{m.group("prefix")}{new_version}"\n', content)
+    cargo_lock_path.write_text(new_content)
+    return True
 
-def update_cargo_lock() -> None:
-    """Updates Cargo.lock by running cargo build."""
+def update_cargo_lock(cargo_toml_content: str, current_version: str, new_version: str) -> None:
+    """Updates the workspace crate versions in Cargo.lock without building."""
+    members = get_workspace_members(cargo_toml_content)
+    if members is not None and update_cargo_lock_inplace(Path("Cargo.lock"), members, current_version, new_version):
+        return
     try:
-        run_command(["cargo", "build", "--quiet"])
-    except subprocess.CalledProcessError as e:
-        print(f"{YELLOW}Warning:{NC} cargo build had some output (this might be normal)")
-        print(e.stderr)
+        try:
+            run_command(["cargo", "update", "--workspace", "--offline", "--quiet"])
+        except subprocess.CalledProcessError:
+            # The offline registry cache may be incomplete; retry with network access
+            run_command(["cargo", "update", "--workspace", "--quiet"])
+    except subprocess.CalledProcessError:
+        print(f"{YELLOW}Warning:{NC} cargo update failed; Cargo.lock may still list the old version")
 
+@lru_cache(maxsize=1)
 def get_previous_tag() -> Optional[str]:
     """Gets the previous git tag."""
     try:
@@ -164,12 +262,20 @@ def main() -> None:
         print("Please run this script from the project root directory")
         sys.exit(1)
 
+    cargo_toml_content = cargo_toml_path.read_text()
     try:
-        current_version = get_current_version(cargo_toml_path)
+        current_version = get_current_version(cargo_toml_content)
     except ValueError as e:
         print(f"{RED}Error: {e}{NC}")
         sys.exit(1)
 
+    # Resolve the branch while the user is reading the prompts
+    try:
+        branch_query = start_command(["git", "rev-parse", "--abbrev-ref", "HEAD"])
+    except FileNotFoundError:
+        print(f"{RED}Error: 'git' command not found. Is git installed and in your PATH?{NC}")
+        sys.exit(1)
+
     if skip_bump:
         new_version = current_version
         print(f"{BLUE}Tag and Push (skipping bump){NC}")
@@ -188,16 +294,17 @@ def main() -> None:
         reply = input(f"Bump {bump_type} version {current_version} -> {new_version}? (y/N) ").lower()
         if reply != "y":
             print("Aborted.")
+            branch_query.communicate()
             sys.exit(0)
 
         print("")
         print(f"{BLUE}Step 1:{NC} Updating Cargo.toml...")
-        update_cargo_toml(cargo_toml_path, current_version, new_version)
+        update_cargo_toml(cargo_toml_path, cargo_toml_content, current_version, new_version)
         print(f"{GREEN}✓{NC} Updated Cargo.toml (workspace.package and workspace.dependencies)")
 
         print("")
-        print(f"{BLUE}Step 2:{NC} Updating Cargo.lock (running cargo build)...")
-        update_cargo_lock()
+        print(f"{BLUE}Step 2:{NC} Updating Cargo.lock...")
+        update_cargo_lock(cargo_toml_content, current_version, new_version)
         print(f"{GREEN}✓{NC} Updated Cargo.lock")
 
         print("")
@@ -247,14 +354,14 @@ def main() -> None:
         else:
             print(f"  {step}. Create tag:     {YELLOW}git tag v{new_version}{NC}")
         step += 1
-        print(f"  {step}. Push:           {YELLOW}git push && git push origin v{new_version}{NC}")
+        print(f"  {step}. Push:           {YELLOW}git push --atomic origin HEAD v{new_version}{NC}")
         print("")
         print("GitHub Actions will then automatically publish to all platforms.")
+        branch_query.communicate()
         sys.exit(0)
 
     try:
-        current_branch_result = run_command(["git", "rev-parse", "--abbrev-ref", "HEAD"], capture_output=True)
-        current_branch = current_branch_result.stdout.strip()
+        current_branch = finish_command(branch_query)
 
         if not skip_bump:
             print("")
@@ -280,8 +387,7 @@ def main() -> None:
         print("")
         step_num = "Step 2" if skip_bump else "Step 6"
         print(f"{BLUE}{step_num}:{NC} Pushing to origin...")
-        run_command(["git", "push", "origin", current_branch])
-        run_command(["git", "push", "origin", f"v{new_version}"])
+        run_command(["git", "push", "--atomic", "origin", current_branch, tag_name])
         print(f"{GREEN}✓{NC} Pushed")
 
         print("")